@@ -2,7 +2,7 @@ import asyncio
 import warnings
 from typing import Optional
 
-from mitmproxy import controller, ctx, flow, log, master, options, platform
+from mitmproxy import controller, ctx, exceptions, flow, log, master, options, platform
 from mitmproxy.flow import Error
 from mitmproxy.proxy import commands
 from mitmproxy.proxy import server
@@ -83,6 +83,15 @@ class Proxyserver:
             "proxy_debug", bool, False,
             "Enable debug logs in the proxy core.",
         )
+        loader.add_option(
+            "stream_websocket_messages", Optional[str], None,
+            """
+            Stream WebSocket messages to the other peer once more than the given amount of data has been buffered.
+            Streamed messages are still passed to the websocket_message event once complete, but their content
+            is replaced with a summary (e.g. "[streamed message, 1048576 bytes]") and they cannot be modified or
+            killed. Understands k/m/g suffixes, i.e. 3m for 3 megabytes.
+            """
+        )
 
     def running(self):
         self.master = ctx.master
@@ -91,6 +100,11 @@ class Proxyserver:
         self.configure(["listen_port"])
 
     def configure(self, updated):
+        if "stream_websocket_messages" in updated:
+            try:
+                human.parse_size(ctx.options.stream_websocket_messages)
+            except ValueError as e:
+                raise exceptions.OptionsError(e)
         if not self.is_running:
             return
         if "mode" in updated and ctx.options.mode == "transparent":  # pragma: no cover
@@ -1,18 +1,23 @@
+import copy
+import functools
 from dataclasses import dataclass
-from typing import Iterator, List
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
 
 import wsproto
 import wsproto.extensions
 import wsproto.frame_protocol
-import wsproto.utilities
 from mitmproxy import connection, flow, http, websocket
 from mitmproxy.proxy import commands, events, layer
 from mitmproxy.proxy.commands import StartHook
 from mitmproxy.proxy.context import Context
 from mitmproxy.proxy.utils import expect
+from mitmproxy.utils import human
 from wsproto import ConnectionState
 from wsproto.frame_protocol import CloseReason, Opcode
 
+_CAN_SEND_CLOSE = frozenset({ConnectionState.OPEN, ConnectionState.REMOTE_CLOSING})
+_NORMAL_CLOSE_CODES = frozenset({1000, 1001, 1005})
+
 
 @dataclass
 class WebsocketStartHook(StartHook):
@@ -57,20 +62,22 @@ class WebsocketConnection(wsproto.Connection):
     A very thin wrapper around wsproto.Connection:
 
      - we keep the underlying connection as an attribute for easy access.
-     - we add a framebuffer for incomplete messages
-     - we wrap .send() so that we can directly yield it.
+     - we add a framebuffer for incomplete messages, along with the lengths of the received frames
+     - we keep track of whether (and how much of) the current message is being streamed
     """
     conn: connection.Connection
-    frame_buf: List[bytes]
+    frame_buf: bytearray
+    frame_lens: List[int]
+    streaming: bool
+    streamed_bytes: int
 
     def __init__(self, *args, conn: connection.Connection, **kwargs):
         super(WebsocketConnection, self).__init__(*args, **kwargs)
         self.conn = conn
-        self.frame_buf = []
-
-    def send2(self, event: wsproto.events.Event) -> commands.SendData:
-        data = self.send(event)
-        return commands.SendData(self.conn, data)
+        self.frame_buf = bytearray()
+        self.frame_lens = []
+        self.streaming = False
+        self.streamed_bytes = 0
 
     def __repr__(self):
         return f"WebsocketConnection<{self.state.name}, {self.conn}>"
@@ -83,6 +90,7 @@ class WebsocketLayer(layer.Layer):
     flow: http.HTTPFlow
     client_ws: WebsocketConnection
     server_ws: WebsocketConnection
+    stream_threshold: Optional[int]
 
     def __init__(self, context: Context, flow: http.HTTPFlow):
         super().__init__(context)
@@ -91,6 +99,7 @@ class WebsocketLayer(layer.Layer):
 
     @expect(events.Start)
     def start(self, _) -> layer.CommandGenerator[None]:
+        self.stream_threshold = human.parse_size(self.context.options.stream_websocket_messages)
 
         client_extensions = []
         server_extensions = []
@@ -99,14 +108,19 @@ class WebsocketLayer(layer.Layer):
         assert self.flow.response  # satisfy type checker
         ext_header = self.flow.response.headers.get("Sec-WebSocket-Extensions", "")
         if ext_header:
-            for ext in wsproto.utilities.split_comma_header(ext_header.encode("ascii", "replace")):
+            # The header value is already a str, no need to round-trip through bytes for splitting.
+            for ext in ext_header.split(","):
+                ext = ext.strip()
+                if not ext:
+                    continue
                 ext_name = ext.split(";", 1)[0].strip()
                 if ext_name == wsproto.extensions.PerMessageDeflate.name:
                     client_deflate = wsproto.extensions.PerMessageDeflate()
                     client_deflate.finalize(ext)
                     client_extensions.append(client_deflate)
-                    server_deflate = wsproto.extensions.PerMessageDeflate()
-                    server_deflate.finalize(ext)
+                    # Both sides negotiate the same parameters, so we parse the offer only once.
+                    # No compression context has been created yet, so a shallow copy is independent.
+                    server_deflate = copy.copy(client_deflate)
                     server_extensions.append(server_deflate)
                 else:
                     yield commands.Log(f"Ignoring unknown WebSocket extension {ext_name!r}.")
@@ -124,8 +138,7 @@ class WebsocketLayer(layer.Layer):
     def relay_messages(self, event: events.ConnectionEvent) -> layer.CommandGenerator[None]:
         assert self.flow.websocket  # satisfy type checker
 
-        from_client = event.connection == self.context.client
-        from_str = 'client' if from_client else 'server'
+        from_client = event.connection is self.context.client
         if from_client:
             src_ws = self.client_ws
             dst_ws = self.server_ws
@@ -134,6 +147,9 @@ class WebsocketLayer(layer.Layer):
             dst_ws = self.client_ws
 
         if isinstance(event, events.DataReceived):
+            if not event.data:
+                # nothing to parse, don't bother wsproto with it.
+                return
             src_ws.receive_data(event.data)
         elif isinstance(event, events.ConnectionClosed):
             src_ws.receive_data(None)
@@ -141,53 +157,153 @@ class WebsocketLayer(layer.Layer):
             raise AssertionError(f"Unexpected event: {event}")
 
         for ws_event in src_ws.events():
-            if isinstance(ws_event, wsproto.events.Message):
-                is_text = isinstance(ws_event.data, str)
-                if is_text:
-                    typ = Opcode.TEXT
-                    src_ws.frame_buf.append(ws_event.data.encode())
-                else:
-                    typ = Opcode.BINARY
-                    src_ws.frame_buf.append(ws_event.data)
-
-                if ws_event.message_finished:
-                    content = b"".join(src_ws.frame_buf)
-
-                    fragmentizer = Fragmentizer(src_ws.frame_buf, is_text)
-                    src_ws.frame_buf.clear()
-
-                    message = websocket.WebSocketMessage(typ, from_client, content)
-                    self.flow.websocket.messages.append(message)
-                    yield WebsocketMessageHook(self.flow)
+            handler = self._ws_event_handlers.get(type(ws_event))
+            if handler is None:  # pragma: no cover
+                raise AssertionError(f"Unexpected WebSocket event: {ws_event}")
+            yield from handler(self, ws_event, from_client, src_ws, dst_ws)
+
+    def _relay_message(
+        self,
+        ws_event: wsproto.events.Message,
+        from_client: bool,
+        src_ws: WebsocketConnection,
+        dst_ws: WebsocketConnection,
+        typ: Opcode,
+    ) -> layer.CommandGenerator[None]:
+        assert self.flow.websocket  # satisfy type checker
 
-                    if not message.killed:
-                        for msg in fragmentizer(message.content):
-                            yield dst_ws.send2(msg)
+        is_text = typ is Opcode.TEXT
+        if is_text:
+            data = ws_event.data.encode()
+        else:
+            data = ws_event.data
+
+        if not ws_event.message_finished:
+            src_ws.frame_buf.extend(data)
+            src_ws.frame_lens.append(len(data))
+            if self.stream_threshold is not None and len(src_ws.frame_buf) >= self.stream_threshold:
+                if not src_ws.streaming:
+                    yield commands.Log(f"Streaming WebSocket message from {'client' if from_client else 'server'}.")
+                    src_ws.streaming = True
+                yield self._stream_frame_buf(src_ws, dst_ws, is_text, False)
+            return
 
-            elif isinstance(ws_event, (wsproto.events.Ping, wsproto.events.Pong)):
+        if src_ws.streaming:
+            # Everything but the remainder has already been forwarded. We still report the message,
+            # but only with a summary as content. It can neither be modified nor killed anymore.
+            src_ws.frame_buf.extend(data)
+            yield self._stream_frame_buf(src_ws, dst_ws, is_text, True)
+            summary = f"[streamed message, {src_ws.streamed_bytes} bytes]".encode()
+            src_ws.streaming = False
+            src_ws.streamed_bytes = 0
+            message = websocket.WebSocketMessage(typ, from_client, summary)
+            self.flow.websocket.messages.append(message)
+            yield WebsocketMessageHook(self.flow)
+            if message.killed or message.content is not summary:
                 yield commands.Log(
-                    f"Received WebSocket {ws_event.__class__.__name__.lower()} from {from_str} "
-                    f"(payload: {bytes(ws_event.payload)!r})"
+                    "WebSocket message has already been streamed, modifying or killing it has no effect.",
+                    "warn"
                 )
-                yield dst_ws.send2(ws_event)
-            elif isinstance(ws_event, wsproto.events.CloseConnection):
-                self.flow.websocket.closed_by_client = from_client
-                self.flow.websocket.close_code = ws_event.code
-                self.flow.websocket.close_reason = ws_event.reason
-
-                for ws in [self.server_ws, self.client_ws]:
-                    if ws.state in {ConnectionState.OPEN, ConnectionState.REMOTE_CLOSING}:
-                        # response == original event, so no need to differentiate here.
-                        yield ws.send2(ws_event)
-                    yield commands.CloseConnection(ws.conn)
-                if ws_event.code in {1000, 1001, 1005}:
-                    yield WebsocketEndHook(self.flow)
-                else:
-                    self.flow.error = flow.Error(f"WebSocket Error: {format_close_event(ws_event)}")
-                    yield WebsocketErrorHook(self.flow)
-                self._handle_event = self.done
-            else:  # pragma: no cover
-                raise AssertionError(f"Unexpected WebSocket event: {ws_event}")
+            return
+
+        original_text = None
+        if src_ws.frame_lens:
+            src_ws.frame_buf.extend(data)
+            src_ws.frame_lens.append(len(data))
+            content = bytes(src_ws.frame_buf)
+            src_ws.frame_buf.clear()
+            # hand over the list of frame lengths instead of copying it.
+            fragmentizer = Fragmentizer(src_ws.frame_lens, is_text)
+            src_ws.frame_lens = []
+        else:
+            # single-frame message, no need to go through the frame buffer.
+            # wsproto hands out binary payloads as bytearray, but message content must be bytes.
+            content = bytes(data)
+            fragmentizer = Fragmentizer([len(data)], is_text)
+            if is_text:
+                original_text = ws_event.data
+
+        message = websocket.WebSocketMessage(typ, from_client, content)
+        self.flow.websocket.messages.append(message)
+        yield WebsocketMessageHook(self.flow)
+
+        if not message.killed:
+            msgs: Iterable[wsproto.events.Message]
+            if original_text is not None and message.content is content:
+                # unmodified text message, we can skip decoding the content again.
+                msgs = [wsproto.events.TextMessage(original_text)]
+            else:
+                msgs = fragmentizer(message.content)
+            # Send all fragments of a message in one go rather than issuing one write per frame.
+            wire_data = b"".join(dst_ws.send(msg) for msg in msgs)
+            yield commands.SendData(dst_ws.conn, wire_data)
+
+    @staticmethod
+    def _stream_frame_buf(
+        src_ws: WebsocketConnection,
+        dst_ws: WebsocketConnection,
+        is_text: bool,
+        message_finished: bool,
+    ) -> commands.SendData:
+        msg: wsproto.events.Message
+        if is_text:
+            # The buffer only ever contains complete str fragments, so this is valid UTF-8.
+            msg = wsproto.events.TextMessage(src_ws.frame_buf.decode(), message_finished=message_finished)
+        else:
+            msg = wsproto.events.BytesMessage(src_ws.frame_buf, message_finished=message_finished)  # type: ignore
+        cmd = commands.SendData(dst_ws.conn, dst_ws.send(msg))
+        src_ws.streamed_bytes += len(src_ws.frame_buf)
+        src_ws.frame_buf.clear()
+        src_ws.frame_lens = []
+        return cmd
+
+    def _relay_ping_pong(
+        self,
+        ws_event: Union[wsproto.events.Ping, wsproto.events.Pong],
+        from_client: bool,
+        src_ws: WebsocketConnection,
+        dst_ws: WebsocketConnection,
+    ) -> layer.CommandGenerator[None]:
+        from_str = 'client' if from_client else 'server'
+        yield commands.Log(
+            f"Received WebSocket {ws_event.__class__.__name__.lower()} from {from_str} "
+            f"(payload: {bytes(ws_event.payload)!r})"
+        )
+        yield commands.SendData(dst_ws.conn, dst_ws.send(ws_event))
+
+    def _relay_close(
+        self,
+        ws_event: wsproto.events.CloseConnection,
+        from_client: bool,
+        src_ws: WebsocketConnection,
+        dst_ws: WebsocketConnection,
+    ) -> layer.CommandGenerator[None]:
+        assert self.flow.websocket  # satisfy type checker
+
+        self.flow.websocket.closed_by_client = from_client
+        self.flow.websocket.close_code = ws_event.code
+        self.flow.websocket.close_reason = ws_event.reason
+
+        for ws in [self.server_ws, self.client_ws]:
+            if ws.state in _CAN_SEND_CLOSE:
+                # response == original event, so no need to differentiate here.
+                yield commands.SendData(ws.conn, ws.send(ws_event))
+            yield commands.CloseConnection(ws.conn)
+        if ws_event.code in _NORMAL_CLOSE_CODES:
+            yield WebsocketEndHook(self.flow)
+        else:
+            self.flow.error = flow.Error(f"WebSocket Error: {format_close_event(ws_event)}")
+            yield WebsocketErrorHook(self.flow)
+        self._handle_event = self.done
+
+    # Dispatch on the exact event type, which is cheaper than a chain of isinstance checks.
+    _ws_event_handlers: Dict[type, Callable[..., layer.CommandGenerator[None]]] = {
+        wsproto.events.TextMessage: functools.partial(_relay_message, typ=Opcode.TEXT),
+        wsproto.events.BytesMessage: functools.partial(_relay_message, typ=Opcode.BINARY),
+        wsproto.events.Ping: _relay_ping_pong,
+        wsproto.events.Pong: _relay_ping_pong,
+        wsproto.events.CloseConnection: _relay_close,
+    }
 
     @expect(events.DataReceived, events.ConnectionClosed)
     def done(self, _) -> layer.CommandGenerator[None]:
@@ -214,36 +330,45 @@ class Fragmentizer:
         Some WebSocket servers reject large payload sizes.
 
     As a workaround, we either retain the original chunking or, if the payload has been modified, use ~4kB chunks.
+    Binary chunks are memoryviews into the message content, so no per-chunk buffers need to be allocated.
     """
     # A bit less than 4kb to accommodate for headers.
     FRAGMENT_SIZE = 4000
 
-    def __init__(self, fragments: List[bytes], is_text: bool):
-        assert fragments
-        self.fragment_lengths = [len(x) for x in fragments]
+    def __init__(self, fragment_lengths: List[int], is_text: bool):
+        assert fragment_lengths
+        self.fragment_lengths = fragment_lengths
+        self.total_length = sum(fragment_lengths)
         self.is_text = is_text
 
-    def msg(self, data: bytes, message_finished: bool):
+    def msg(self, data: Union[bytes, memoryview], message_finished: bool):
         if self.is_text:
-            data_str = data.decode(errors="replace")
+            data_str = str(data, "utf-8", errors="replace")
             return wsproto.events.TextMessage(data_str, message_finished=message_finished)
         else:
-            return wsproto.events.BytesMessage(data, message_finished=message_finished)
+            # wsproto accepts any buffer here, so we can pass the memoryview without copying.
+            return wsproto.events.BytesMessage(data, message_finished=message_finished)  # type: ignore
 
     def __call__(self, content: bytes) -> Iterator[wsproto.events.Message]:
         if not content:
+            # empty messages are valid, they consist of a single empty frame.
+            yield self.msg(content, True)
             return
-        if len(content) == sum(self.fragment_lengths):
+        if len(self.fragment_lengths) == 1 and len(content) <= self.FRAGMENT_SIZE:
+            # single-frame message (the common case), no need to slice anything.
+            yield self.msg(content, True)
+            return
+        mv = memoryview(content)
+        if len(content) == self.total_length:
             # message has the same length, we can reuse the same sizes
             offset = 0
             for fl in self.fragment_lengths[:-1]:
-                yield self.msg(content[offset:offset + fl], False)
+                yield self.msg(mv[offset:offset + fl], False)
                 offset += fl
-            yield self.msg(content[offset:], True)
+            yield self.msg(mv[offset:], True)
         else:
-            offset = 0
-            total = len(content) - self.FRAGMENT_SIZE
-            while offset < total:
-                yield self.msg(content[offset:offset + self.FRAGMENT_SIZE], False)
-                offset += self.FRAGMENT_SIZE
-            yield self.msg(content[offset:], True)
+            # start of the last chunk, which may be shorter than FRAGMENT_SIZE.
+            last = (len(content) - 1) // self.FRAGMENT_SIZE * self.FRAGMENT_SIZE
+            for offset in range(0, last, self.FRAGMENT_SIZE):
+                yield self.msg(mv[offset:offset + self.FRAGMENT_SIZE], False)
+            yield self.msg(mv[last:], True)
@@ -3,6 +3,7 @@ from contextlib import asynccontextmanager
 
 import pytest
 
+from mitmproxy import exceptions
 from mitmproxy.addons.proxyserver import Proxyserver
 from mitmproxy.proxy.layers.http import HTTPMode
 from mitmproxy.proxy import layers
@@ -81,3 +82,11 @@ async def test_warn_no_nextlayer():
         await tctx.master.await_log("Proxy server listening at", level="info")
         assert tctx.master.has_log("Warning: Running proxyserver without nextlayer addon!", level="warn")
         await ps.shutdown_server()
+
+
+def test_options():
+    ps = Proxyserver()
+    with taddons.context(ps) as tctx:
+        with pytest.raises(exceptions.OptionsError):
+            tctx.configure(ps, stream_websocket_messages="invalid")
+        tctx.configure(ps, stream_websocket_messages="1m")
@@ -100,6 +100,7 @@ def test_upgrade(tctx):
     assert flow().websocket.messages[0].from_client
     assert flow().websocket.messages[0].type == Opcode.TEXT
     assert flow().websocket.messages[1].content == b"hello back"
+    assert type(flow().websocket.messages[1].content) is bytes
     assert flow().websocket.messages[1].from_client is False
     assert flow().websocket.messages[1].type == Opcode.BINARY
 
@@ -159,6 +160,32 @@ def test_drop_message(ws_testdata):
     )
 
 
+def test_empty_message(ws_testdata):
+    tctx, playbook, flow = ws_testdata
+    assert (
+            playbook
+            << websocket.WebsocketStartHook(flow)
+            >> reply()
+            >> DataReceived(tctx.server, b"\x81\x00")
+            << websocket.WebsocketMessageHook(flow)
+            >> reply()
+            << SendData(tctx.client, b"\x81\x00")
+    )
+    assert flow.websocket.messages[-1].content == b""
+
+
+def test_empty_data(ws_testdata):
+    tctx, playbook, flow = ws_testdata
+    assert (
+            playbook
+            << websocket.WebsocketStartHook(flow)
+            >> reply()
+            >> DataReceived(tctx.server, b"")
+            << None
+    )
+    assert not flow.websocket.messages
+
+
 def test_fragmented(ws_testdata):
     tctx, playbook, flow = ws_testdata
     assert (
@@ -169,12 +196,53 @@ def test_fragmented(ws_testdata):
             >> DataReceived(tctx.server, b"\x80\x03bar")
             << websocket.WebsocketMessageHook(flow)
             >> reply()
-            << SendData(tctx.client, b"\x01\x03foo")
-            << SendData(tctx.client, b"\x80\x03bar")
+            << SendData(tctx.client, b"\x01\x03foo\x80\x03bar")
     )
     assert flow.websocket.messages[-1].content == b"foobar"
 
 
+def test_stream(ws_testdata):
+    tctx, playbook, flow = ws_testdata
+    tctx.options.stream_websocket_messages = "4"
+    assert (
+            playbook
+            << websocket.WebsocketStartHook(flow)
+            >> reply()
+            >> DataReceived(tctx.server, b"\x01\x03foo")
+            >> DataReceived(tctx.server, b"\x00\x03bar")
+            << Log("Streaming WebSocket message from server.")
+            << SendData(tctx.client, b"\x01\x06foobar")
+            >> DataReceived(tctx.server, b"\x00\x02ba")
+            >> DataReceived(tctx.server, b"\x00\x02zz")
+            << SendData(tctx.client, b"\x00\x04bazz")
+            >> DataReceived(tctx.server, b"\x80\x01!")
+            << SendData(tctx.client, b"\x80\x01!")
+            << websocket.WebsocketMessageHook(flow)
+            >> reply()
+            >> DataReceived(tctx.server, b"\x82\x03foo")
+            << websocket.WebsocketMessageHook(flow)
+            >> reply()
+            << SendData(tctx.client, b"\x82\x03foo")
+            >> DataReceived(tctx.server, b"\x02\x04abcd")
+            << Log("Streaming WebSocket message from server.")
+            << SendData(tctx.client, b"\x02\x04abcd")
+            >> DataReceived(tctx.server, b"\x80\x00")
+            << SendData(tctx.client, b"\x80\x00")
+            << websocket.WebsocketMessageHook(flow)
+    )
+    flow.websocket.messages[-1].kill()
+    assert (
+            playbook
+            >> reply()
+            << Log("WebSocket message has already been streamed, modifying or killing it has no effect.", "warn")
+    )
+    assert flow.websocket.messages[0].content == b"[streamed message, 11 bytes]"
+    assert flow.websocket.messages[0].type == Opcode.TEXT
+    assert flow.websocket.messages[1].content == b"foo"
+    assert flow.websocket.messages[2].content == b"[streamed message, 4 bytes]"
+    assert flow.websocket.messages[2].type == Opcode.BINARY
+
+
 def test_protocol_error(ws_testdata):
     tctx, playbook, flow = ws_testdata
     assert (
@@ -280,13 +348,23 @@ def test_deflate(ws_testdata):
             << websocket.WebsocketMessageHook(flow)
             >> reply()
             << SendData(tctx.client, bytes.fromhex("c1 07 f2 48 cd c9 c9 07 00"))
+            >> DataReceived(tctx.client, masked_bytes(bytes.fromhex("c1 07 f2 48 cd c9 c9 07 00")))
+            << websocket.WebsocketMessageHook(flow)
+            >> reply()
+            << SendData(tctx.server, masked(bytes.fromhex("c1 07 f2 48 cd c9 c9 07 00")))
+            # https://tools.ietf.org/html/rfc7692#section-7.2.3.2
+            # This only round-trips if both directions have their own compression context.
+            >> DataReceived(tctx.server, bytes.fromhex("c1 05 f2 00 11 00 00"))
+            << websocket.WebsocketMessageHook(flow)
+            >> reply()
+            << SendData(tctx.client, bytes.fromhex("c1 05 f2 00 11 00 00"))
     )
-    assert flow.websocket.messages[0].content == b"Hello"
+    assert [m.content for m in flow.websocket.messages] == [b"Hello", b"Hello", b"Hello"]
 
 
 def test_unknown_ext(ws_testdata):
     tctx, playbook, flow = ws_testdata
-    flow.response.headers["Sec-WebSocket-Extensions"] = "funky-bits; param=42"
+    flow.response.headers["Sec-WebSocket-Extensions"] = "funky-bits; param=42, "
     assert (
             playbook
             << Log("Ignoring unknown WebSocket extension 'funky-bits'.")
@@ -302,20 +380,32 @@ def test_websocket_connection_repr(tctx):
 
 class TestFragmentizer:
     def test_empty(self):
-        f = websocket.Fragmentizer([b"foo"], False)
-        assert list(f(b"")) == []
+        f = websocket.Fragmentizer([3], False)
+        assert list(f(b"")) == [
+            wsproto.events.BytesMessage(b"", message_finished=True),
+        ]
+
+    def test_single_fragment(self):
+        f = websocket.Fragmentizer([3], True)
+        assert list(f(b"foobar")) == [
+            wsproto.events.TextMessage("foobar", message_finished=True),
+        ]
 
     def test_keep_sizes(self):
-        f = websocket.Fragmentizer([b"foo", b"bar"], True)
+        f = websocket.Fragmentizer([3, 3], True)
         assert list(f(b"foobaz")) == [
             wsproto.events.TextMessage("foo", message_finished=False),
             wsproto.events.TextMessage("baz", message_finished=True),
         ]
 
     def test_rechunk(self):
-        f = websocket.Fragmentizer([b"foo"], False)
+        f = websocket.Fragmentizer([3], False)
         f.FRAGMENT_SIZE = 4
         assert list(f(b"foobar")) == [
             wsproto.events.BytesMessage(b"foob", message_finished=False),
             wsproto.events.BytesMessage(b"ar", message_finished=True),
         ]
+        assert list(f(b"foobarba")) == [
+            wsproto.events.BytesMessage(b"foob", message_finished=False),
+            wsproto.events.BytesMessage(b"arba", message_finished=True),
+        ]